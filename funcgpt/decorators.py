@@ -34,5 +34,5 @@ def gpt(
         )
     else:
         return lambda f_: create_generic_wrapper(
-            f_, model=model, temperature=temperature, max_tokens=max_tokens
+            f=f_, model=model, temperature=temperature, max_tokens=max_tokens
         )
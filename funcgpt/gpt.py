@@ -1,12 +1,23 @@
-import re
-from codecs import getreader
-from json import dumps, loads
-from typing import IO, Iterator, Literal, cast
-from urllib.request import Request, urlopen
+import atexit
+import os
+from functools import lru_cache
+from typing import Any, Iterable, Iterator, Literal
+
+import httpx
 
 from funcgpt.credentials import OPENAI_API_KEY, OPENAI_ORG_ID
 from funcgpt.message import Message
 
+try:
+    from orjson import dumps, loads
+except ImportError:
+    from json import dumps as json_dumps
+    from json import loads
+
+    def dumps(obj: Any) -> bytes:
+        return json_dumps(obj).encode()
+
+
 DEFAULT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
 
 BASE_HEADERS = {
@@ -17,83 +28,223 @@ BASE_HEADERS = {
 if OPENAI_ORG_ID is not None:
     BASE_HEADERS["OpenAI-Organization"] = OPENAI_ORG_ID
 
-match_data = re.compile(r"^data: (.*)(?:\r\n|\r|\n)$").match
 
-match_empty_line = re.compile(r"^(?:\r\n|\r|\n)$").match
+def create_session() -> httpx.Client:
+    """
+    Create an HTTP client for requests to the OpenAI API.
+
+    :return: The HTTP client, with the base headers set and no timeout.
+    """
+    return httpx.Client(headers=BASE_HEADERS, timeout=None)
 
-utf8reader = getreader("utf-8")
 
+# Shared HTTP client, so that consecutive requests reuse the same keep-alive connection
+# instead of paying for a new TCP and TLS handshake every time, along with the ID of the
+# process that created it
+SESSION: httpx.Client | None = None
+SESSION_PID: int | None = None
 
-def stream(
+
+def get_session() -> httpx.Client:
+    """
+    Get the shared HTTP client, creating it on first use.
+
+    A new client is also created when the current process isn't the one that created the
+    client, such as in forked child processes, which would otherwise share the pooled
+    connections of their parent. The inherited client is dropped without being closed,
+    as closing it would also shut down the connections the parent is still using.
+
+    :return: The shared HTTP client of the current process.
+    """
+    global SESSION, SESSION_PID
+
+    pid = os.getpid()
+    if SESSION is None or SESSION_PID != pid:
+        SESSION = create_session()
+        SESSION_PID = pid
+
+    return SESSION
+
+
+def close_session() -> None:
+    """
+    Close the shared HTTP client, if it has been created by the current process.
+    """
+    if SESSION is not None and SESSION_PID == os.getpid():
+        SESSION.close()
+
+
+atexit.register(close_session)
+
+# Skeletons for the request payloads, copied and filled in on each request
+ANSWER_REQUEST_TEMPLATE: dict[str, Any] = {"model": None, "messages": None, "temperature": 0}
+STREAM_REQUEST_TEMPLATE: dict[str, Any] = {**ANSWER_REQUEST_TEMPLATE, "stream": True}
+
+
+# Content of the final user message when encoding request templates, replaced on each request
+CONTENT_PLACEHOLDER = "\x00content\x00"
+
+
+@lru_cache(maxsize=16)
+def parse_url(url: str) -> httpx.URL:
+    """
+    Parse a URL, caching the result for endpoints that are requested repeatedly.
+
+    :param url: The URL to be parsed.
+    :return: The parsed URL.
+    """
+    return httpx.URL(url)
+
+
+def get_event_data(event: bytes) -> bytes | None:
+    """
+    Extract the data of a server-sent event.
+
+    :param event: The event, with its lines separated by b"\n" and without its terminating blank
+                  line.
+    :return: The data of the event, or None if it carries no data.
+    """
+    data = [line[6:] for line in event.split(b"\n") if line.startswith(b"data: ")]
+
+    return b"\n".join(data) if data else None
+
+
+def iter_event_data(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Extract the data of the server-sent events in a stream of byte chunks.
+
+    Events are split from the stream as soon as their terminating blank line arrives,
+    and only their "data" fields are kept. Lines may end with b"\r\n", b"\n" or b"\r".
+
+    :param chunks: An iterable over chunks of bytes, as received from the network.
+    :return: An iterator over the data of each event carrying any.
+    """
+    buffer = b""
+
+    for chunk in chunks:
+        buffer += chunk
+
+        # Normalize line terminators, so that events are always separated by b"\n\n". A trailing
+        # b"\r" may be the first half of a b"\r\n" split across chunks, so it's kept as is
+        # until the next chunk arrives.
+        if b"\r" in buffer:
+            tail = b"\r" if buffer.endswith(b"\r") else b""
+            buffer = buffer[: len(buffer) - len(tail)]
+            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n") + tail
+
+        # Keep the last, possibly incomplete, event in the buffer
+        *events, buffer = buffer.split(b"\n\n")
+
+        for event in events:
+            if (data := get_event_data(event)) is not None:
+                yield data
+
+    # At the end of the stream, a trailing b"\r" can only be a line terminator of its own
+    if buffer.endswith(b"\r"):
+        *events, _ = (buffer[:-1] + b"\n").split(b"\n\n")
+
+        for event in events:
+            if (data := get_event_data(event)) is not None:
+                yield data
+
+
+def encode_request(
     model: Literal["gpt-3.5-turbo", "gpt-4"],
     messages: list[Message],
-    temperature: int = 0,
+    temperature: float = 0,
     stop: str | list[str] | None = None,
-    chat_completions_url: str = DEFAULT_COMPLETIONS_URL,
-) -> Iterator[str]:
+    stream: bool = False,
+) -> bytes:
     """
-    Stream the chat completions for a given model, messages and other parameters.
+    Encode the body of a request to the chat completions API.
 
     :param model: The identifier of the AI model to be used. Can be either "gpt-3.5-turbo" or "gpt-4".
-    :param messages: A list of dictionaries representing the message history to be passed to the model.
-    :param temperature: Controls randomness in the AI response. Higher values result in more random
-                        completions, while lower values steer the model towards more focused responses.
+    :param messages: A list of Message TypedDicts.
+    :param temperature: Controls randomness in the model's response. Default is 0.
     :param stop: A string or list of strings to specify sequence(s) at which the API will stop
                  generating further tokens. Default is None.
-    :param chat_completions_url: The URL endpoint for fetching chat completions. The default value
-                                 is DEFAULT_COMPLETIONS_URL.
-
-    :return: An iterator over the formatted chat completions.
-
-    :raises ValueError: Raised if the provided temperature is less than 0.
-
-    .. note:: If the model does not return a completion, the iterator will ignore the response and
-              not yield anything.
+    :param stream: Whether the response should be streamed. Default is False.
+    :return: The JSON-encoded request body.
     """
     # Prepare request payload with model, messages, and temperature
-    requestArguments = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "stream": True,
-    }
+    if stream:
+        requestArguments = STREAM_REQUEST_TEMPLATE.copy()
+    else:
+        requestArguments = ANSWER_REQUEST_TEMPLATE.copy()
+    requestArguments["model"] = model
+    requestArguments["messages"] = messages
+    requestArguments["temperature"] = temperature
 
     # Add "stop" parameter if provided
     if stop is not None:
         requestArguments["stop"] = stop
 
-    request = Request(
-        url=chat_completions_url,
-        data=dumps(requestArguments).encode(),
-        headers=BASE_HEADERS,
+    return dumps(requestArguments)
+
+
+def encode_request_template(
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+    messages: list[Message],
+    temperature: float = 0,
+    stop: str | list[str] | None = None,
+    stream: bool = False,
+) -> tuple[bytes, bytes]:
+    """
+    Encode the body of a request to the chat completions API, leaving out the content of a final
+    user message appended to the given messages.
+
+    The body of a request for a given content is the prefix, followed by the JSON-encoded content,
+    followed by the suffix. Requests differing only by that content can then be built without
+    encoding the other messages again.
+
+    :param model: The identifier of the AI model to be used. Can be either "gpt-3.5-turbo" or "gpt-4".
+    :param messages: A list of Message TypedDicts, to be followed by the user message.
+    :param temperature: Controls randomness in the model's response. Default is 0.
+    :param stop: A string or list of strings to specify sequence(s) at which the API will stop
+                 generating further tokens. Default is None.
+    :param stream: Whether the response should be streamed. Default is False.
+    :return: The prefix and the suffix of the request body.
+    """
+    body = encode_request(
+        model=model,
+        messages=[*messages, {"role": "user", "content": CONTENT_PLACEHOLDER}],
+        temperature=temperature,
+        stop=stop,
+        stream=stream,
     )
 
-    with urlopen(request) as f:  # type: IO[bytes]
-        fstr = cast(IO[str], utf8reader(f))
-        data = ""
+    # The final user message comes after all other messages, so its content is the last match
+    prefix, _, suffix = body.rpartition(dumps(CONTENT_PLACEHOLDER))
 
-        while True:
-            line = fstr.readline()
+    return prefix, suffix
 
-            # If data is empty, look for a valid data line
-            if not data:
-                if (dataMatch := match_data(line)) is not None:
-                    data = dataMatch.group(1)
-                continue
 
-            # If it's not an empty line, reset the data and continue
-            if match_empty_line(line) is None:
-                data = ""
-                continue
+def stream_encoded(
+    body: bytes,
+    chat_completions_url: str = DEFAULT_COMPLETIONS_URL,
+) -> Iterator[str]:
+    """
+    Stream the chat completions for an already encoded request body.
+
+    :param body: The JSON-encoded request body, as returned by `encode_request` with stream=True.
+    :param chat_completions_url: The URL endpoint for fetching chat completions. The default value
+                                 is DEFAULT_COMPLETIONS_URL.
+    :return: An iterator over the formatted chat completions.
+
+    :raises httpx.HTTPStatusError: Raised if the API responds with an HTTP error status.
+    """
+    with get_session().stream("POST", parse_url(chat_completions_url), content=body) as response:
+        response.raise_for_status()
 
+        # Parse the stream as bytes, leaving the decoding of the data itself to the JSON parser
+        for data in iter_event_data(response.iter_bytes()):
             # If data received is "[DONE]", break the loop
-            if data == "[DONE]":
+            if data == b"[DONE]":
                 break
 
             # Process and yield the completion
-            body = loads(data)
-            data = ""
-            delta = body["choices"][0]["delta"]
+            responseBody = loads(data)
+            delta = responseBody["choices"][0]["delta"]
 
             if "content" not in delta:
                 continue
@@ -103,57 +254,94 @@ def stream(
             yield deltaContent
 
 
-def answer(
+def stream(
     model: Literal["gpt-3.5-turbo", "gpt-4"],
     messages: list[Message],
-    temperature: float = 0,
+    temperature: int = 0,
     stop: str | list[str] | None = None,
     chat_completions_url: str = DEFAULT_COMPLETIONS_URL,
-) -> str:
+) -> Iterator[str]:
     """
-    Query an OpenAI model with a list of messages and get the model's answer.
+    Stream the chat completions for a given model, messages and other parameters.
 
     :param model: The identifier of the AI model to be used. Can be either "gpt-3.5-turbo" or "gpt-4".
-    :param messages: A list of Message TypedDicts.
-    :param temperature: Controls randomness in the model's response. Higher values (e.g., 1) will
-                        generate more random answers, while lower values (e.g., 0) make the model
-                        more deterministic. Default is 0.
+    :param messages: A list of dictionaries representing the message history to be passed to the model.
+    :param temperature: Controls randomness in the AI response. Higher values result in more random
+                        completions, while lower values steer the model towards more focused responses.
     :param stop: A string or list of strings to specify sequence(s) at which the API will stop
                  generating further tokens. Default is None.
     :param chat_completions_url: The URL endpoint for fetching chat completions. The default value
                                  is DEFAULT_COMPLETIONS_URL.
-    :raises OverflowError: Raised if the model's response exceeds the maximum length.
-    :return: The assistant's generated response as a string.
-    """
-    # Prepare request payload with model, messages, and temperature
-    requestArguments = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-    }
 
-    # Add "stop" parameter if provided
-    if stop is not None:
-        requestArguments["stop"] = stop
+    :return: An iterator over the formatted chat completions.
+
+    :raises ValueError: Raised if the provided temperature is less than 0.
+    :raises httpx.HTTPStatusError: Raised if the API responds with an HTTP error status.
 
-    # Prepare the HTTP request
-    request = Request(
-        url=chat_completions_url,
-        data=dumps(requestArguments).encode(),
-        headers=BASE_HEADERS,
+    .. note:: If the model does not return a completion, the iterator will ignore the response and
+              not yield anything.
+    """
+    body = encode_request(
+        model=model, messages=messages, temperature=temperature, stop=stop, stream=True
     )
 
+    return stream_encoded(body, chat_completions_url=chat_completions_url)
+
+
+def answer_encoded(
+    body: bytes,
+    chat_completions_url: str = DEFAULT_COMPLETIONS_URL,
+) -> str:
+    """
+    Query an OpenAI model with an already encoded request body and get the model's answer.
+
+    :param body: The JSON-encoded request body, as returned by `encode_request`.
+    :param chat_completions_url: The URL endpoint for fetching chat completions. The default value
+                                 is DEFAULT_COMPLETIONS_URL.
+    :raises OverflowError: Raised if the model's response exceeds the maximum length.
+    :raises httpx.HTTPStatusError: Raised if the API responds with an HTTP error status.
+    :return: The assistant's generated response as a string.
+    """
     # Send the request to OpenAI's chat completions API
-    response = urlopen(request)
+    response = get_session().post(parse_url(chat_completions_url), content=body)
+    response.raise_for_status()
 
     # Parse the response JSON
-    body = loads(response.read())
+    responseBody = loads(response.content)
 
     # Get the first choice
-    choice = body["choices"][0]
+    choice = responseBody["choices"][0]
 
     if choice["finish_reason"] == "length":
         raise OverflowError("The model's response exceeded the maximum length.")
 
     # Extract and return the assistant's response
     return choice["message"]["content"]
+
+
+def answer(
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+    messages: list[Message],
+    temperature: float = 0,
+    stop: str | list[str] | None = None,
+    chat_completions_url: str = DEFAULT_COMPLETIONS_URL,
+) -> str:
+    """
+    Query an OpenAI model with a list of messages and get the model's answer.
+
+    :param model: The identifier of the AI model to be used. Can be either "gpt-3.5-turbo" or "gpt-4".
+    :param messages: A list of Message TypedDicts.
+    :param temperature: Controls randomness in the model's response. Higher values (e.g., 1) will
+                        generate more random answers, while lower values (e.g., 0) make the model
+                        more deterministic. Default is 0.
+    :param stop: A string or list of strings to specify sequence(s) at which the API will stop
+                 generating further tokens. Default is None.
+    :param chat_completions_url: The URL endpoint for fetching chat completions. The default value
+                                 is DEFAULT_COMPLETIONS_URL.
+    :raises OverflowError: Raised if the model's response exceeds the maximum length.
+    :raises httpx.HTTPStatusError: Raised if the API responds with an HTTP error status.
+    :return: The assistant's generated response as a string.
+    """
+    body = encode_request(model=model, messages=messages, temperature=temperature, stop=stop)
+
+    return answer_encoded(body, chat_completions_url=chat_completions_url)
@@ -1,6 +1,11 @@
 import bz2
+import os
+import sys
+from functools import lru_cache
+from hashlib import sha256
 from pathlib import Path
-from typing import Literal, TypedDict
+from tempfile import NamedTemporaryFile
+from typing import Iterable, Literal, Sequence, TypedDict
 from unittest.mock import patch
 from urllib.parse import urlparse
 
@@ -9,7 +14,12 @@ from tiktoken_ext.openai_public import cl100k_base
 
 from funcgpt.message import Message
 
-__all__ = ["serialize_to_gpt", "get_token_count"]
+__all__ = [
+    "get_cl100k_im_encoding",
+    "serialize_to_gpt",
+    "get_token_count",
+    "get_token_count_upper_bound",
+]
 
 MSG_SEP = {
     "gpt-3.5-turbo": "\n",
@@ -31,32 +41,96 @@ IM_END = {
     "gpt-4": "<|im_end|>",
 }
 
+# Number of threads used for encoding long message histories in parallel
+ENCODE_THREADS = os.cpu_count() or 1
+
+# Minimum total content length of a message history for it to be encoded in parallel,
+# below which the overhead of dispatching to threads outweighs the gains
+PARALLEL_ENCODE_MIN_CHARS = 50_000
+
+# Maximum content length of a message for its encoding to be cached
+CACHED_MESSAGE_MAX_CHARS = 8_192
+
+
+def get_cache_dir() -> Path:
+    """
+    Determine the directory where decompressed copies of the bundled data files are stored.
+
+    The TIKTOKEN_CACHE_DIR environment variable is used if set. Otherwise, the directory is
+    a "funcgpt" subdirectory of the platform's user cache directory.
+
+    :return: The path of the cache directory, which might not exist yet.
+    """
+    if cache_dir := os.getenv("TIKTOKEN_CACHE_DIR"):
+        return Path(cache_dir)
+
+    if sys.platform == "win32":
+        base_dir = Path(os.getenv("LOCALAPPDATA") or Path.home() / "AppData" / "Local")
+    elif sys.platform == "darwin":
+        base_dir = Path.home() / "Library" / "Caches"
+    else:
+        base_dir = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache")
+
+    return base_dir / "funcgpt"
+
 
 def read_file_cached(blobpath: str) -> bytes:
     """
     Reads a cached file given a URL path to the original file.
 
     The cache is stored in the "data" directory, and the cached files are
-    compressed using the bz2 format. If the cached file is not found, this
-    function raises a FileNotFoundError.
+    compressed using the bz2 format. The first time a file is read, a
+    decompressed copy is written to the user cache directory (see
+    `get_cache_dir`), named after the hash of the compressed file, so that
+    later reads skip decompression and never pick up a copy of an outdated
+    file. If the cache directory is not writable, the file is decompressed
+    on every read instead. If the cached file is not found, this function
+    raises a FileNotFoundError.
 
     :param blobpath: The URL path of the original file.
                      Example: "https://example.com/data/file.txt"
     :return: The content of the cached file as bytes.
     :raises FileNotFoundError: If the cached file is not found.
     """
-    # Get the cache directory path
-    cache_dir = Path(__file__).parent / "data"
+    # Get the data directory path
+    data_dir = Path(__file__).parent / "data"
 
-    # Generate the cache key by extracting the file name from the URL and adding ".bz2" extension
-    cache_key = Path(urlparse(blobpath).path).name + ".bz2"
+    # Generate the cache key by extracting the file name from the URL
+    cache_key = Path(urlparse(blobpath).path).name
 
-    # Construct the full cache file path
-    cache_path = cache_dir / cache_key
+    # Read the bz2-compressed cached file
+    compressed = (data_dir / f"{cache_key}.bz2").read_bytes()
 
-    # Read and return the content of the bz2-compressed cached file
-    with bz2.open(cache_path, "rb") as f:
-        return f.read()
+    # Construct the path of the decompressed copy, which changes along with the compressed file
+    digest = sha256(compressed).hexdigest()[:16]
+    cache_dir = get_cache_dir()
+    cache_path = cache_dir / f"{cache_key}-{digest}"
+
+    # Read and return the decompressed copy of the cached file, if already available
+    try:
+        return cache_path.read_bytes()
+    except OSError:
+        pass
+
+    # Decompress the content of the cached file
+    content = bz2.decompress(compressed)
+
+    # Store the decompressed copy, renaming it into place so that concurrent
+    # readers never see a partially written file
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = NamedTemporaryFile(dir=cache_dir, prefix=f".{cache_key}.", delete=False)
+    except OSError:
+        return content
+
+    try:
+        with tmp:
+            tmp.write(content)
+        Path(tmp.name).replace(cache_path)
+    except OSError:
+        Path(tmp.name).unlink(missing_ok=True)
+
+    return content
 
 
 class EncodingParameters(TypedDict):
@@ -66,11 +140,17 @@ class EncodingParameters(TypedDict):
     special_tokens: dict[str, int]
 
 
+@lru_cache(maxsize=1)
 @patch("tiktoken.load.read_file_cached", read_file_cached)
 def get_cl100k_im_encoding() -> TikTokenEncoding:
     """
     Generate a tiktoken Encoding for cl100k_im with appropriate special tokens.
 
+    The encoding is only built on the first call, and the same instance is
+    returned afterwards. Calling it before forking worker processes (with the
+    "fork" start method, when using multiprocessing) lets them share the
+    parent's encoding instead of each building their own.
+
     :return: the tiktoken Encoding instance
     """
     # Obtain base encoding parameters for cl100k
@@ -90,7 +170,118 @@ def get_cl100k_im_encoding() -> TikTokenEncoding:
     )
 
 
-CL100K_IM_ENCODING = get_cl100k_im_encoding()
+@lru_cache(maxsize=None)
+def _encode_markers(
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    """
+    Encode the fixed pieces of text used when serializing messages for the specified GPT model.
+
+    :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
+    :return: The encoding indices of the message separator and of the final assistant prompt.
+    """
+    encoding = get_cl100k_im_encoding()
+
+    return (
+        tuple(encoding.encode(MSG_SEP[model], allowed_special="all")),
+        tuple(encoding.encode(f"{IM_START[model]}assistant{IM_SEP[model]}", allowed_special="all")),
+    )
+
+
+def _format_message(
+    role: str,
+    content: str,
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+) -> str:
+    """
+    Format a single message into the text consumed by the specified GPT model.
+
+    :param role: The role of the message sender ("system", "user", or "assistant").
+    :param content: The text content of the message.
+    :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
+    :return: The serialized message.
+    """
+    return f"{IM_START[model]}{role}{IM_SEP[model]}{content}{IM_END[model]}"
+
+
+def _encode_message(
+    role: str,
+    content: str,
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+) -> list[int]:
+    """
+    Encode a single message in the format consumed by the specified GPT model.
+
+    :param role: The role of the message sender ("system", "user", or "assistant").
+    :param content: The text content of the message.
+    :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
+    :return: A list of integer encoding indices that represent the serialized message.
+    """
+    serialized = _format_message(role, content, model)
+
+    return get_cl100k_im_encoding().encode(serialized, allowed_special="all")
+
+
+@lru_cache(maxsize=256)
+def _encode_message_cached(
+    role: str,
+    content: str,
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+) -> tuple[int, ...]:
+    """
+    Encode a single message like `_encode_message`, caching the result, so that messages
+    repeated across calls (such as the instructions of a wrapped function) are only
+    tokenized once.
+
+    Only used for messages of up to CACHED_MESSAGE_MAX_CHARS characters, which bounds the
+    memory held by the cache.
+
+    :param role: The role of the message sender ("system", "user", or "assistant").
+    :param content: The text content of the message.
+    :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
+    :return: A tuple of integer encoding indices that represent the serialized message.
+    """
+    return tuple(_encode_message(role, content, model))
+
+
+def _encode_messages(
+    messages: list[Message],
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+) -> Iterable[Sequence[int]]:
+    """
+    Encode each of the given messages in the format consumed by the specified GPT model.
+
+    Long message histories are encoded in parallel, using tiktoken's thread pool, while
+    the others are encoded one message at a time, caching all but the last message when
+    they are short.
+
+    :param messages: A list of message dictionaries, where each dictionary contains a "role" (either
+                     "system", "user", or "assistant") and a "content" (string).
+    :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
+    :return: The integer encoding indices of each message, in order.
+    """
+    if (
+        ENCODE_THREADS > 1
+        and len(messages) > 1
+        and sum(len(message["content"]) for message in messages) >= PARALLEL_ENCODE_MIN_CHARS
+    ):
+        return get_cl100k_im_encoding().encode_batch(
+            [_format_message(message["role"], message["content"], model) for message in messages],
+            num_threads=ENCODE_THREADS,
+            allowed_special="all",
+        )
+
+    # The last message is the one changing from call to call (such as the input of a wrapped
+    # function), so it's never cached, and neither are other long messages
+    last = len(messages) - 1
+    return (
+        (
+            _encode_message_cached(message["role"], message["content"], model)
+            if index < last and len(message["content"]) <= CACHED_MESSAGE_MAX_CHARS
+            else _encode_message(message["role"], message["content"], model)
+        )
+        for index, message in enumerate(messages)
+    )
 
 
 def serialize_to_gpt(
@@ -101,27 +292,26 @@ def serialize_to_gpt(
     Serialize the given list of messages to a format that can be consumed by the specified GPT model by
     converting them into their respective encoding indices.
 
+    Each message is encoded on its own and the results are joined with the encoded
+    separator. Since every message starts and ends with a special token, this yields
+    the same indices as encoding the whole serialized text at once.
+
     :param messages: A list of message dictionaries, where each dictionary contains a "role" (either
                      "system", "user", or "assistant") and a "content" (string).
     :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
     :return: A list of integer encoding indices that represent the serialized messages.
     """
-    # Constants for the start, end, and separator placeholders
-    imStart = IM_START[model]
-    imEnd = IM_END[model]
-    imSep = IM_SEP[model]
-    msgSep = MSG_SEP[model]
+    separator, assistantPrompt = _encode_markers(model)
 
-    pieces = []
-    for message in messages:
-        # Format each message into its corresponding encoded format
-        pieces.append(f"{imStart}{message['role']}{imSep}{message['content']}{imEnd}")
+    serialized: list[int] = []
+    for encodedMessage in _encode_messages(messages, model):
+        # Append each encoded message, followed by the separator
+        serialized += encodedMessage
+        serialized += separator
     # Add the final assistant prompt
-    pieces.append(f"{imStart}assistant{imSep}")
-    # Join the encoded message pieces with a separator
-    serialized = msgSep.join(pieces)
+    serialized += assistantPrompt
 
-    return CL100K_IM_ENCODING.encode(serialized, allowed_special="all")
+    return serialized
 
 
 def get_token_count(
@@ -136,4 +326,51 @@ def get_token_count(
     :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
     :return: The total number of tokens in the serialized messages.
     """
-    return len(serialize_to_gpt(messages, model))
+    separator, assistantPrompt = _encode_markers(model)
+
+    # Add up the lengths of the encoded pieces, without joining them
+    count = len(assistantPrompt) + len(separator) * len(messages)
+    for encodedMessage in _encode_messages(messages, model):
+        count += len(encodedMessage)
+
+    return count
+
+
+def _utf8_length(text: str) -> int:
+    """
+    Determine the length of a string once encoded to UTF-8.
+
+    :param text: The string to be measured.
+    :return: The number of bytes in the UTF-8 encoding of the string.
+    """
+    # ASCII strings have one byte per character, and checking for them doesn't scan the string
+    return len(text) if text.isascii() else len(text.encode())
+
+
+def get_token_count_upper_bound(
+    messages: list[Message],
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+) -> int:
+    """
+    Determine an upper bound for the number of tokens for a given list of messages, without
+    tokenizing them.
+
+    Every token stands for at least one byte of the serialized messages, so the length of
+    their UTF-8 encoding is never smaller than the actual number of tokens.
+
+    :param messages: A list of message dictionaries, where each dictionary contains a "role" (either
+                     "system", "user", or "assistant") and a "content" (string).
+    :param model: The GPT model to be used ("gpt-3.5-turbo" or "gpt-4").
+    :return: An upper bound for the total number of tokens in the serialized messages.
+    """
+    # Length of the text around each message, and of the final assistant prompt
+    messageFraming = _utf8_length(
+        f"{IM_START[model]}{IM_SEP[model]}{IM_END[model]}{MSG_SEP[model]}"
+    )
+    assistantPrompt = _utf8_length(f"{IM_START[model]}assistant{IM_SEP[model]}")
+
+    bound = assistantPrompt + messageFraming * len(messages)
+    for message in messages:
+        bound += _utf8_length(message["role"]) + _utf8_length(message["content"])
+
+    return bound
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
-from functools import wraps
-from inspect import signature
+from functools import lru_cache, wraps
+from inspect import isfunction, signature
 from textwrap import dedent
-from typing import Callable, Iterator, Literal
+from typing import Any, Callable, Iterator, Literal
 
-from funcgpt.gpt import answer, stream
-from funcgpt.tokentools import get_token_count
+from funcgpt.gpt import answer_encoded, dumps, encode_request_template, stream_encoded
+from funcgpt.message import Message
+from funcgpt.tokentools import get_token_count, get_token_count_upper_bound
 
 MAX_TOKENS = {
     "gpt-3.5-turbo": 4096,
@@ -16,54 +17,55 @@ MAX_TOKENS = {
 DEFAULT_PROMPT_TOKENS_SHARE = 0.875  # 7/8
 
 
-def create_generic_wrapper(
+def answer_bool(body: bytes) -> bool:
+    """
+    Query an OpenAI model like `answer_encoded`, interpreting the model's answer as a boolean.
+
+    :param body: The JSON-encoded request body.
+    :return: True if the model answered true, False otherwise.
+    """
+    return "true" in answer_encoded(body).lower()
+
+
+# Engines used for generating responses from encoded request bodies, along with the options to
+# encode these requests with, by the return annotation of the wrapped callable
+ENGINES: dict[Any, tuple[Callable[[bytes], str | Iterator[str] | bool], dict[str, Any]]] = {
+    str: (answer_encoded, {}),
+    Iterator[str]: (stream_encoded, {"stream": True}),
+    bool: (answer_bool, {"stop": ["true", "false"]}),
+}
+
+
+def _create_generic_wrapper(
     f: Callable,
     model: Literal["gpt-3.5-turbo", "gpt-4"],
     temperature: int,
-    max_tokens: int | None = None,
+    max_tokens: int | None,
 ) -> Callable[[str], str | Iterator[str]]:
     """
-    Create a generic wrapper for a callable (typically a function) to generate response
-    based on the callable's signature and docstring.
-
-    :param f: The callable to be wrapped.
-    :param model: The OpenAI model to use for generating responses. Must be one of:
-                  "gpt-3.5-turbo" or "gpt-4".
-    :param temperature: The temperature value to use for generating the responses.
-                        Lower values make the responses more focused and deterministic,
-                        while higher values make them more diverse.
-    :param max_tokens: The maximum number of tokens for the input prompt. If not provided,
-                        the maximum number of tokens will be determined based on the model
-                        and the default prompt tokens share.
-
-    :return: A wrapped callable that generates responses according to the specifications
-             and instructions provided in the function docstring.
-
-    :raises ValueError: If the callable does not have a docstring or if the return
-                        annotation is not of the types str, Iterator[str] or bool.
+    Create a generic wrapper for a callable, as described in `create_generic_wrapper`,
+    without caching it.
     """
     # Extract the callable's docstring
     fdoc: str | None = f.__doc__
     if fdoc is None:
         raise ValueError("Function must have a docstring")
 
-    # Extract the callable's return annotation
-    fsig = signature(f)
-    return_annotation = fsig.return_annotation
+    # Extract the callable's return annotation, reading it directly from plain functions
+    # instead of building their full signature
+    if isfunction(f):
+        return_annotation = f.__annotations__.get("return")
+    else:
+        return_annotation = signature(f).return_annotation
 
     # Determine the engine to use for generating responses
-    if return_annotation is str:
-        engine = answer
-    elif return_annotation is Iterator[str]:
-        engine = stream
-    elif return_annotation is bool:
-        # Wrap the answer function with special handling for boolean return values
-        engine = (
-            lambda *args, **kwargs: "true"
-            in answer(*args, **kwargs, stop=["true", "false"]).lower()
-        )
-    else:
+    try:
+        engineEntry = ENGINES.get(return_annotation)
+    except TypeError:  # unhashable annotation
+        engineEntry = None
+    if engineEntry is None:
         raise ValueError("Function must have a return annotation of str, Iterator[str], or bool")
+    engine, requestOptions = engineEntry
 
     # Create the instructions for the GPT engine
     instructions = "You should answer to inputs according to the following specification:\n\n"
@@ -87,23 +89,74 @@ def create_generic_wrapper(
     if max_tokens is None:
         max_tokens = int(MAX_TOKENS[model] * DEFAULT_PROMPT_TOKENS_SHARE)
 
+    # Build the system message once, as it doesn't change between calls
+    systemMessage: Message = {"role": systemRole, "content": instructions}
+
+    # Encode the request body once, leaving out only the content of the user message
+    bodyPrefix, bodySuffix = encode_request_template(
+        model=model,
+        messages=[systemMessage],
+        temperature=temperature,
+        **requestOptions,
+    )
+
     # Create the wrapper function
     @wraps(f)
     def wrapper(message: str) -> str | Iterator[str]:
-        messages = [
-            {"role": systemRole, "content": instructions},
-            {"role": "user", "content": message},
-        ]
-        message_tokens_count = get_token_count(messages=messages, model=model)
-        if message_tokens_count > max_tokens:
-            raise ValueError(
-                f"Message exceeds maximum number of tokens ({message_tokens_count} > {max_tokens})"
-            )
-        return engine(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-        )
+        messages: list[Message] = [systemMessage, {"role": "user", "content": message}]
+
+        # Only tokenize the messages if they could exceed the maximum number of tokens
+        if get_token_count_upper_bound(messages=messages, model=model) > max_tokens:
+            message_tokens_count = get_token_count(messages=messages, model=model)
+            if message_tokens_count > max_tokens:
+                raise ValueError(
+                    f"Message exceeds maximum number of tokens "
+                    f"({message_tokens_count} > {max_tokens})"
+                )
+
+        return engine(b"".join((bodyPrefix, dumps(message), bodySuffix)))
 
     # Return the wrapper function
     return wrapper
+
+
+_create_generic_wrapper_cached = lru_cache(maxsize=128)(_create_generic_wrapper)
+
+
+def create_generic_wrapper(
+    f: Callable,
+    model: Literal["gpt-3.5-turbo", "gpt-4"],
+    temperature: int,
+    max_tokens: int | None = None,
+) -> Callable[[str], str | Iterator[str]]:
+    """
+    Create a generic wrapper for a callable (typically a function) to generate response
+    based on the callable's signature and docstring.
+
+    The most recently created wrappers are cached, so wrapping the same callable with the
+    same parameters again returns the existing wrapper. The cache keeps strong references to
+    up to 128 callables; callables that can't be hashed are wrapped without caching.
+
+    :param f: The callable to be wrapped.
+    :param model: The OpenAI model to use for generating responses. Must be one of:
+                  "gpt-3.5-turbo" or "gpt-4".
+    :param temperature: The temperature value to use for generating the responses.
+                        Lower values make the responses more focused and deterministic,
+                        while higher values make them more diverse.
+    :param max_tokens: The maximum number of tokens for the input prompt. If not provided,
+                        the maximum number of tokens will be determined based on the model
+                        and the default prompt tokens share.
+
+    :return: A wrapped callable that generates responses according to the specifications
+             and instructions provided in the function docstring.
+
+    :raises ValueError: If the callable does not have a docstring or if the return
+                        annotation is not of the types str, Iterator[str] or bool.
+    """
+    # Only cache wrappers for callables that can be used as cache keys
+    try:
+        hash(f)
+    except TypeError:
+        return _create_generic_wrapper(f, model, temperature, max_tokens)
+
+    return _create_generic_wrapper_cached(f, model, temperature, max_tokens)